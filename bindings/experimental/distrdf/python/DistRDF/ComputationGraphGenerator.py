@@ -247,7 +247,8 @@ def run_with_cppworkflow(graph: Dict[int, "Node"], starting_node: ROOT.RDF.RNode
     # Generate the code of the C++ workflow
     cpp_workflow = CppWorkflow(graph, starting_node, range_id)
 
-    logger.debug(f"Generated C++ workflow is:\n{cpp_workflow}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Generated C++ workflow is:\n{cpp_workflow.application_code}")
 
     # Compile and run the C++ workflow on the received RDF head node
     return cpp_workflow.execute()
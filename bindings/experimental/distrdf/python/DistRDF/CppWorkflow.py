@@ -9,10 +9,18 @@
 # For the list of contributors see $ROOTSYS/README/CREDITS.                    #
 ################################################################################
 
+import atexit
+import hashlib
+import logging
 import os
-from copy import deepcopy
-from functools import singledispatch
-from typing import Dict, List, NamedTuple, Tuple
+import shutil
+import socket
+import stat
+import tempfile
+import time
+from copy import copy
+from functools import lru_cache, singledispatch
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 from textwrap import dedent
 
 from DistRDF.Node import Node
@@ -22,6 +30,23 @@ from DistRDF.PythonMergeables import SnapshotResult
 import ROOT
 
 
+logger = logging.getLogger(__name__)
+
+# Directory of the on-disk cache of compiled workflows, set on first use
+_CACHE_DIR: Optional[str] = None
+
+# Seconds after which the compilation lock of a workflow is considered stale
+_COMPILATION_TIMEOUT = 600
+
+# Whether ROOT.RDF.RunGraphs was already set to release the GIL
+_RUNGRAPHS_RELEASES_GIL = False
+
+# Separator between the generated statements of the graph nodes. They are all
+# emitted in a single line to reduce the size of the code to be parsed by
+# ACLiC, unless the DISTRDF_DEBUG_CXX environment variable is set
+_STATEMENT_SEP = "\n  " if os.environ.get("DISTRDF_DEBUG_CXX") else ""
+
+
 class _SnapshotData(NamedTuple):
     res_id: int
     treename: str
@@ -33,6 +58,19 @@ class _PyActionData(NamedTuple):
     operation: Operation
 
 
+class _CodegenContext:
+    """
+    Mutable state of the code generation, passed through the node handlers
+    while the computation graph is traversed. If `emit_code` is False, the
+    handlers only collect the information needed to run the workflow.
+    """
+    __slots__ = ("res_ptr_id", "emit_code")
+
+    def __init__(self, res_ptr_id: int, emit_code: bool):
+        self.res_ptr_id = res_ptr_id
+        self.emit_code = emit_code
+
+
 @singledispatch
 def _create_lazy_op_if_needed(operation: Operation, _: int) -> Operation:
     return operation
@@ -47,7 +85,10 @@ def _(operation: AsNumpy, _: int) -> AsNumpy:
 @_create_lazy_op_if_needed.register
 def _(operation: Snapshot, range_id: int) -> Snapshot:
 
-    op_modified = deepcopy(operation)
+    # Only the list of arguments is modified, so there is no need to deep copy
+    # the whole operation
+    op_modified = copy(operation)
+    op_modified.args = list(operation.args)
 
     # Retrieve filename and append range boundaries
     filename = op_modified.args[1].partition(".root")[0]
@@ -74,6 +115,188 @@ def _(operation: Snapshot, range_id: int) -> Snapshot:
     return op_modified
 
 
+@lru_cache(maxsize=None)
+def _resolve_lazy_op_fn(op_type: type) -> Callable[[Operation, int], Operation]:
+    """
+    Returns the implementation of `_create_lazy_op_if_needed` for the given
+    operation type, so that the dispatch is resolved only once per type.
+    """
+    return _create_lazy_op_if_needed.dispatch(op_type)
+
+
+def _is_private_dir(path: str) -> bool:
+    """
+    Checks that a directory is owned by the current user and that no other
+    user can write to it, so that the libraries it contains can be trusted.
+    """
+    st = os.lstat(path)
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _get_cache_dir() -> str:
+    """
+    Returns the directory where compiled workflow libraries are cached, so that
+    they can be reused by other processes of the same user running the same
+    workflow. It can be set via the DISTRDF_WF_CACHE environment variable,
+    otherwise a per-user directory in the temporary directory is used.
+
+    Since the libraries of the cache are loaded in the current process, the
+    directory is only used if it belongs to the current user and no one else
+    can write to it. Otherwise, a directory private to the current process is
+    created instead, and removed when the process exits.
+
+    Files are never removed from the shared cache: every distinct workflow
+    (e.g. every range of a distributed Snapshot) adds its C++ source and the
+    files produced by ACLiC. Point DISTRDF_WF_CACHE to a location that is
+    cleaned periodically, or remove the directory between runs, to bound its
+    size.
+    """
+    global _CACHE_DIR
+    if _CACHE_DIR is None:
+        cache_dir = os.environ.get("DISTRDF_WF_CACHE",
+                                   os.path.join(tempfile.gettempdir(), f"distrdf_wf_cache_{os.getuid()}"))
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            trusted = _is_private_dir(cache_dir)
+        except OSError:
+            trusted = False
+
+        if not trusted:
+            logger.warning(f"The RDataFrame workflow cache directory {cache_dir} cannot be created or is writable by "
+                           "other users. Compiled workflows will not be shared with other processes.")
+            cache_dir = tempfile.mkdtemp(prefix="distrdf_wf_cache_")
+            atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+
+        _CACHE_DIR = cache_dir
+
+    return _CACHE_DIR
+
+
+def _is_stale_lock(lock_path: str) -> bool:
+    """
+    Checks whether a compilation lock was left behind by a process that was
+    killed or preempted. The lock contains the host name and the pid of its
+    owner: on the same host, the lock is stale if and only if that process does
+    not exist anymore. Locks of owners on other hosts are considered stale if
+    they are older than _COMPILATION_TIMEOUT seconds.
+    """
+    try:
+        with open(lock_path) as f:
+            host, _, pid = f.read().partition(" ")
+        age = time.time() - os.path.getmtime(lock_path)
+    except FileNotFoundError:
+        # The lock was just released
+        return False
+
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # The process exists, but belongs to another user
+            pass
+        return False
+
+    return age > _COMPILATION_TIMEOUT
+
+
+def _acquire_compilation_lock(lock_path: str, so_path: str) -> bool:
+    """
+    Waits until the current process is the only one compiling a workflow, by
+    exclusively creating its lock file. Stale locks are removed.
+
+    Returns:
+        bool: True if the lock was acquired, False if the library of the
+            workflow was published by another process in the meantime.
+    """
+    while not os.path.exists(so_path):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            if _is_stale_lock(lock_path):
+                # Take over the compilation. If several processes do it at
+                # the same time they all compile, which is harmless since the
+                # files are published atomically
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+            else:
+                time.sleep(0.1)
+            continue
+
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}")
+        return True
+
+    return False
+
+
+def _build_workflow_library(code: str, lib_id: str) -> str:
+    """
+    Generates the workflow code C++ file and compiles it with ACLiC into a
+    shared library, without loading it.
+
+    Both the generated C++ file and the compiled shared library are stored in
+    an on-disk cache directory (see `_get_cache_dir`), named after `lib_id`, a
+    hash of their code and of the ROOT build, so that processes running the
+    same workflow (possibly on a shared filesystem) reuse them. If another
+    process already compiled the same workflow, ACLiC is not invoked at all.
+    Only the process holding the lock file of the workflow compiles it, while
+    the others wait for the library to appear (see
+    `_acquire_compilation_lock`). Both files are first written under temporary
+    names and then atomically moved to their final names, so that concurrent
+    workers never see a partially written file.
+
+    Returns:
+        str: the path to the shared library of the workflow.
+    """
+    cache_dir = _get_cache_dir()
+    lib_path = os.path.join(cache_dir, f"rdfworkflow_{lib_id}")
+    so_path = f"{lib_path}.{ROOT.gSystem.GetSoExt()}"
+    lock_path = f"{lib_path}.lock"
+
+    if not _acquire_compilation_lock(lock_path, so_path):
+        # Another process already compiled this workflow
+        return so_path
+
+    try:
+        if os.path.exists(so_path):
+            # Another process published the library right before releasing
+            # the lock that we just took
+            return so_path
+
+        # First dump the code in a file
+        cpp_file_name = f"{lib_path}.cxx"
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".cxx", delete=False) as f:
+            f.write(code.encode("utf-8"))
+        os.replace(f.name, cpp_file_name)
+
+        # Now compile the code into a process-specific library, then publish
+        # it in the cache
+        tmp_lib_path = f"{lib_path}_{os.getpid()}"
+        if not ROOT.gSystem.CompileMacro(cpp_file_name, 'Oc', tmp_lib_path):
+            raise RuntimeError(f"Error compiling the RDataFrame workflow file: {cpp_file_name}")
+        os.replace(f"{tmp_lib_path}.{ROOT.gSystem.GetSoExt()}", so_path)
+    finally:
+        # Let processes waiting for this library know whether it appeared
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+    return so_path
+
+
+def _format_tuple_arg(arg: tuple) -> str:
+    """
+    Converts a tuple argument of an operation into a C++ initializer list.
+    """
+    return "{" + ",".join(f'"{elem}"' if isinstance(elem, str) else str(elem) for elem in arg) + "}"
+
+
 class CppWorkflow(object):
     '''
     Class that encapsulates the generation of the code of an RDataFrame workflow
@@ -85,9 +308,10 @@ class CppWorkflow(object):
     optimized and thus slower than a shared library compiled with ACLiC.
 
     Attributes:
-        _CACHED_WFS (dict): uses as key the code of workflow functions that have
-            been already compiled and loaded by the current process, while the
-            value is the id of a given workflow function. Used to prevent
+        _CACHED_WFS (dict): uses as key the BLAKE2b digest of the structure of
+            the graphs of workflow functions that have been already compiled
+            and loaded by the current process, while the value is the id of a
+            given workflow function. Used to prevent regeneration and
             recompilation of already executed workflow functions.
 
         _FUNCTION_NAME (string): name of the function that encapsulates the
@@ -96,6 +320,20 @@ class CppWorkflow(object):
         _FUNCTION_NAMESPACE (string): namespace of the function that
             encapsulates the RDataFrame graph creation
 
+        _HANDLERS (dict): maps operation types to the name of the method that
+            generates their code.
+
+        _RESOLVED_HANDLERS (dict): memoizes the handler found for each
+            concrete operation type, including subclasses of those in
+            _HANDLERS.
+
+        _ARG_FORMATTERS (dict): maps operation argument types to the function
+            that converts them into C++ call arguments.
+
+        _RESOLVED_ARG_FORMATTERS (dict): memoizes the formatter found for each
+            concrete argument type, including subclasses of those in
+            _ARG_FORMATTERS.
+
         graph_nodes (Dict[int, Node]): The nodes of the computation graph.
 
         range_id (int): The id of the current range being processed.
@@ -103,14 +341,29 @@ class CppWorkflow(object):
         starting_node (ROOT.RDF.RNode): A reference to the C++ headnode of the
             computation graph.
 
-        _nodes_code (str): The part of the generated C++ code that includes the
-            representation of the nodes of the computation graph.
+        _nodes_code (List[str]): The parts of the generated C++ code that
+            include the representation of the nodes of the computation graph.
+            They are joined together only once, when the final code is
+            composed.
 
         _application_code (str): The final generated C++ application.
 
+        _graph_hash (bytes): BLAKE2b digest of the structure of the
+            computation graph, used as key of the workflow cache.
+
+        _code_generated (bool): whether the C++ code of the nodes has been
+            generated. It is not when the workflow was found in the cache.
+
+        _code_hash (bytes): BLAKE2b digest of the final C++ application and of
+            the ROOT build that compiles it, which names the files of the
+            workflow in the on-disk cache. It is computed only when the
+            workflow is compiled.
+
+        _wf_id (str): id of the workflow function, derived from _graph_hash.
+
         _includes (string): include statements needed by the workflow.
 
-        _lambdas (string): lambda functions used by the workflow.
+        _lambdas (List[str]): lambda functions used by the workflow.
 
         _lambda_id (int): counter used to generate ids for each defined lambda
             function.
@@ -123,15 +376,32 @@ class CppWorkflow(object):
             generated by graph actions.
 
         _snapshots (list): list that contains _SnapshotData objects
-
-        _WF_ID_COUNTER (int): used to assign new ids to workflow functions
     '''
 
     _FUNCTION_NAME = '__RDF_WORKFLOW_FUNCTION__'
     _FUNCTION_NAMESPACE = 'DistRDF_Internal'
 
-    _CACHED_WFS: Dict[str, int] = {}
-    _WF_ID_COUNTER: int = 0
+    _CACHED_WFS: Dict[bytes, str] = {}
+
+    # Names of the methods that generate the code of specific operation types.
+    # Any other operation is handled by `_handle_op`
+    _HANDLERS: Dict[type, str] = {
+        Action: "_handle_action",
+        Snapshot: "_handle_snapshot",
+        AsNumpy: "_handle_asnumpy",
+    }
+    # Handlers already resolved for each concrete operation type
+    _RESOLVED_HANDLERS: Dict[type, str] = {}
+
+    # Conversion of Python operation arguments to C++ call arguments. The
+    # "lazy_options" string refers to the RSnapshotOptions instance declared
+    # in the generated code, so it is not quoted
+    _ARG_FORMATTERS: Dict[type, Callable[[Any], str]] = {
+        str: lambda arg: arg if arg == "lazy_options" else f'"{arg}"',
+        tuple: _format_tuple_arg,
+    }
+    # Formatters already resolved for each concrete argument type
+    _RESOLVED_ARG_FORMATTERS: Dict[type, Callable[[Any], str]] = {}
 
     def __init__(self, graph_nodes: Dict[int, "Node"], starting_node: ROOT.RDF.RNode, range_id: int):
         '''
@@ -147,20 +417,75 @@ class CppWorkflow(object):
         '''
 
         self._includes = dedent('''
+            #include <stdexcept>
+            #include <string>
             #include <tuple>
+            #include <type_traits>
             #include <utility>
             #include <vector>
             #include "ROOT/RDataFrame.hxx"
             #include "ROOT/RDFHelpers.hxx"
             #include "ROOT/RResultHandle.hxx"
+            #include "TClass.h"
+
+            #ifndef DISTRDF_CPPWORKFLOW_HELPERS
+            #define DISTRDF_CPPWORKFLOW_HELPERS
+            // Strips out the ROOT::RDF::RResultPtr<> part of a result type
+            inline std::string __distrdf_strip_rp(const char *s)
+            {
+               std::string t(s);
+               auto pos = t.find('<');
+               if (pos == std::string::npos)
+                  throw std::runtime_error("Error parsing the result types of RDataFrame workflow");
+               auto first = t.find_first_not_of(' ', pos + 1);
+               auto last = t.find_last_not_of(' ', t.size() - 2);
+               return t.substr(first, last - first + 1);
+            }
+
+            // Looks up the (stripped) name of a result type only once per
+            // type. Empty if the type is unknown
+            template <class T>
+            inline const std::string &__distrdf_typename()
+            {
+               static const std::string s = [] {
+                  auto *c = TClass::GetClass(typeid(T));
+                  return c ? __distrdf_strip_rp(c->GetName()) : std::string();
+               }();
+               return s;
+            }
+
+            // Stores the result of an action, together with its type, in the
+            // vectors returned by the workflow function
+            template <class T>
+            inline void __distrdf_record(T &&n, int id, const char *action,
+                                         std::vector<ROOT::RDF::RResultHandle> &rh,
+                                         std::vector<std::string> &rt)
+            {
+               rh.emplace_back(n);
+               const auto &type = __distrdf_typename<std::decay_t<T>>();
+               if (type.empty())
+                  throw std::runtime_error("Cannot get type of result " + std::to_string(id) + " of action " +
+                                           action + " during generation of RDF C++ workflow");
+               rt.emplace_back(type);
+            }
+
+            namespace DistRDF_Internal {
+            // Copies the results of a workflow in a single call from Python
+            inline std::vector<ROOT::RDF::RResultHandle>
+            __distrdf_clone(const std::vector<ROOT::RDF::RResultHandle> &v)
+            {
+               return {v.begin(), v.end()};
+            }
+            } // namespace DistRDF_Internal
+            #endif
             ''')
-        self._lambdas = ''
+        self._lambdas: List[str] = []
         self._lambda_id = 0
         self._snapshots = []
         self._py_actions = []
 
         # Generated C++ code with only the nodes of the computation graph
-        self._nodes_code: str = ""
+        self._nodes_code: List[str] = []
         # Counter to keep track of how many results the workflow is
         # creating. Needed for the AsNumpy operation
         self._res_ptr_id: int = 0
@@ -168,101 +493,151 @@ class CppWorkflow(object):
         self._application_code: str = None
 
         self.graph_nodes = graph_nodes
-        self.starting_node = ROOT.RDF.AsRNode(starting_node)
+        # Avoid creating a new RNode if the starting node already is one
+        self.starting_node = (starting_node
+                              if isinstance(starting_node, ROOT.RDF.RNode)
+                              else ROOT.RDF.AsRNode(starting_node))
         self.range_id = range_id
 
-        self._handle_op = singledispatch(self._handle_op)
-        self._handle_op.register(Action, self._handle_action)
-        self._handle_op.register(Snapshot, self._handle_snapshot)
-        self._handle_op.register(AsNumpy, self._handle_asnumpy)
+        # Look for the workflow in the cache of this process with a hash of
+        # the structure of the graph, which is much cheaper than generating
+        # its code
+        self._graph_hash: bytes = self._get_graph_hash()
+        # The name of the workflow function only depends on the structure of
+        # the graph, so it is known before generating the code
+        self._wf_id: str = self._graph_hash.hex()[:16]
+        self._code_hash: Optional[bytes] = None
 
-        # Generate the C++ workflow.
-        self._generate_computation_graph()
+        # Generate the C++ workflow. If it was already loaded, only collect
+        # the information needed to run it
+        self._code_generated: bool = self._graph_hash not in CppWorkflow._CACHED_WFS
+        self._generate_computation_graph(emit_code=self._code_generated)
 
     @property
     def application_code(self) -> str:
         """Gather the full C++ application code in a string."""
 
         if self._application_code is None:
+            if not self._code_generated:
+                # The workflow was found in the cache, so its nodes were not
+                # generated yet
+                self._generate_computation_graph(emit_code=True)
+                self._code_generated = True
             # Gather the code for this instance only once
-            self._application_code = self._get_code()
+            self._application_code = self._get_code(self._wf_id)
         return self._application_code
 
     def __repr__(self) -> str:
         '''
-        Generates a string representation for this C++ workflow.
+        Generates a short string representation for this C++ workflow. The
+        generated code is not included, use `application_code` to get it.
         '''
 
-        return self.application_code
+        return f"<CppWorkflow nodes={len(self.graph_nodes)} range={self.range_id}>"
 
-    def _add_node(self, operation: Operation, node_id: int, parent_id: int):
+    def _add_node(self, operation: Operation, node_id: int, parent_id: int, ctx: _CodegenContext):
         """
         Generates the C++ code for a single node of the graph and adds it to the
         internal string representation. Operations are first made lazy and the
         Snapshot operation has special treatment to change the output filename.
         """
 
-        operation = _create_lazy_op_if_needed(operation, self.range_id)
-        self._handle_op(operation, node_id, parent_id)
+        operation = _resolve_lazy_op_fn(type(operation))(operation, self.range_id)
+        self._dispatch(operation, node_id, parent_id, ctx)
 
-    def _compile(self) -> int:
+    def _compile(self) -> str:
         '''
-        Generates the workflow code C++ file and compiles it with ACLiC
-        into a shared library. The library is also loaded as part of the
-        `TSystem::CompileMacro` call.
-
-        The name of the generated C++ file contains both a hash of its
-        code and the ID of the process that created it. This is done to
-        prevent clashes between multiple (non-sandboxed) worker processes
-        that try to write to the same file concurrently.
+        Compiles the workflow code with ACLiC into a shared library (see
+        `_build_workflow_library`) and loads it.
 
         A class-level cache keeps track of the workflows that have been already
         compiled to prevent unncessary recompilation (e.g. when a worker
         process runs multiple times the same workflow).
 
         Returns:
-            int: the id of the workflow function to be executed. Such id is
+            str: the id of the workflow function to be executed. Such id is
                 appended to CppWorkflow._FUNCTION_NAME to prevent name clashes
                 (a worker process might compile and load multiple workflow
-                functions).
+                functions). It is derived from the hash of the structure of
+                the graph, so that the same workflow function has the same
+                name in every process.
         '''
 
         # TODO: Make this function thread-safe? To support Dask threaded
         # workers
 
-        code = self.application_code
-        this_wf_id = CppWorkflow._CACHED_WFS.get(code)
+        key = self._graph_hash
+        this_wf_id = CppWorkflow._CACHED_WFS.get(key)
         if this_wf_id is not None:
             # We already compiled and loaded a workflow function with this
             # code. Return the id of that function
             return this_wf_id
 
-        # We are trying to run this workflow for the first time in this
-        # process. First dump the code in a file with the right function name
-        this_wf_id = CppWorkflow._WF_ID_COUNTER
-        cpp_file_name = 'rdfworkflow_{wf_id}_{pid}.cxx' \
-                        .format(wf_id=this_wf_id, pid=os.getpid())
-        final_code = code.replace(CppWorkflow._FUNCTION_NAME, CppWorkflow._FUNCTION_NAME + str(this_wf_id), 1)
-
-        with open(cpp_file_name, 'w') as f:
-            f.write(final_code)
+        this_wf_id = self._wf_id
+        self._code_hash = self._get_code_hash()
+        so_path = _build_workflow_library(self.application_code, self._code_hash.hex())
 
-        # Now compile and load the code
-        if not ROOT.gSystem.CompileMacro(cpp_file_name, 'O'):
-            raise RuntimeError(f"Error compiling the RDataFrame workflow file: {cpp_file_name}")
+        if ROOT.gSystem.Load(so_path) < 0:
+            raise RuntimeError(f"Error loading the RDataFrame workflow library: {so_path}")
+        # Make sure the interpreter knows about the workflow function,
+        # since the source file of the library might not be reachable
+        if not ROOT.gInterpreter.Declare(self._get_declaration(this_wf_id)):
+            raise RuntimeError(f"Error declaring the RDataFrame workflow function of library: {so_path}")
 
         # Let the cache know there is a new workflow
-        CppWorkflow._CACHED_WFS[code] = this_wf_id
-        CppWorkflow._WF_ID_COUNTER += 1
+        CppWorkflow._CACHED_WFS[key] = this_wf_id
 
         return this_wf_id
 
-    def _generate_computation_graph(self):
+    def _dispatch(self, operation: Operation, node_id: int, parent_id: int, ctx: _CodegenContext):
+        """
+        Calls the code generation method that corresponds to the type of the
+        operation. The method is looked up in the hierarchy of the type only
+        the first time that type is found.
+        """
+
+        op_type = type(operation)
+        handler = CppWorkflow._RESOLVED_HANDLERS.get(op_type)
+        if handler is None:
+            handler = next((CppWorkflow._HANDLERS[base] for base in op_type.__mro__
+                            if base in CppWorkflow._HANDLERS), "_handle_op")
+            CppWorkflow._RESOLVED_HANDLERS[op_type] = handler
+
+        getattr(self, handler)(operation, node_id, parent_id, ctx)
+
+    @staticmethod
+    def _format_arg(arg: Any) -> str:
+        """
+        Converts an operation argument to a C++ call argument. The formatter
+        is looked up in the hierarchy of the argument type only the first time
+        that type is found, so that subclasses of the supported types (e.g.
+        `numpy.str_` or a namedtuple) are converted like their base.
+        """
+
+        arg_type = type(arg)
+        formatter = CppWorkflow._RESOLVED_ARG_FORMATTERS.get(arg_type)
+        if formatter is None:
+            formatter = next((CppWorkflow._ARG_FORMATTERS[base] for base in arg_type.__mro__
+                              if base in CppWorkflow._ARG_FORMATTERS), str)
+            CppWorkflow._RESOLVED_ARG_FORMATTERS[arg_type] = formatter
+
+        return formatter(arg)
+
+    def _generate_computation_graph(self, emit_code: bool = True):
         """
         Generates the RDataFrame computation graph from the nodes stored in the
         input graph.
+
+        Args:
+            emit_code (bool): whether to generate the C++ code of the nodes, or
+                only the information needed to run an already compiled
+                workflow.
         """
 
+        self._nodes_code = []
+        self._snapshots = []
+        self._py_actions = []
+
         # Iterate over the other nodes stored in the dictionary, skipping the head
         # node. We can iterate over the values knowing that the dictionary preserves
         # the order in which it was created. Thus, we traverse the graph from top
@@ -270,8 +645,14 @@ class CppWorkflow(object):
         nodes = iter(self.graph_nodes.items())
         _ = next(nodes)
 
+        # The counters are kept in a context object and the method in a local
+        # variable during the traversal, then stored back in the instance
+        ctx = _CodegenContext(0, emit_code)
+        add_node = self._add_node
         for node_id, node in nodes:
-            self._add_node(node.operation, node_id, node.parent_id)
+            add_node(node.operation, node_id, node.parent_id, ctx)
+
+        self._res_ptr_id = ctx.res_ptr_id
 
     def _get_args_call(self, operation: Operation) -> str:
         '''
@@ -289,29 +670,8 @@ class CppWorkflow(object):
         # - Do a more thorough type conversion
         # - Use RDF helper functions to convert jitted strings to lambdas
 
-        args = ""
-
         # Argument type conversion
-        for narg, arg in enumerate(operation.args):
-            if (narg > 0):
-                args += ', '
-
-            if arg == "lazy_options":
-                args += "lazy_options"
-            elif isinstance(arg, str):
-                args += '"{}"'.format(arg)
-            elif isinstance(arg, tuple):
-                args += '{'
-                for nelem, elem in enumerate(arg):
-                    if nelem > 0:
-                        args += ','
-                    if isinstance(elem, str):
-                        args += '"{}"'.format(elem)
-                    else:
-                        args += '{}'.format(elem)
-                args += '}'
-
-        return args
+        return ", ".join(self._format_arg(arg) for arg in operation.args)
 
     def _get_args_template(self, operation: Operation) -> str:
         '''
@@ -330,7 +690,7 @@ class CppWorkflow(object):
 
         return ''
 
-    def _get_code(self) -> str:
+    def _get_code(self, wf_id: str) -> str:
         '''
         Composes the workflow generation code from the different attributes
         of this class. The resulting code contains a function that will be
@@ -340,6 +700,9 @@ class CppWorkflow(object):
         2. A vector with the result types of those actions.
         3. A vector of RDF nodes that will be used in Python to invoke
         Python-only actions on them (e.g. `AsNumpy`).
+
+        Args:
+            wf_id (str): id of the workflow function, appended to its name.
         '''
 
         code = '''
@@ -356,6 +719,9 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
   std::vector<ROOT::RDF::RResultHandle> result_handles;
   std::vector<std::string> result_types;
   std::vector<ROOT::RDF::RNode> output_nodes;
+  result_handles.reserve({n_results});
+  result_types.reserve({n_results});
+  output_nodes.reserve({n_py_actions});
 
   // To make Snapshots lazy
   ROOT::RDF::RSnapshotOptions lazy_options;
@@ -369,39 +735,92 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
 }}
 
 }} // namespace {namespace}
-'''.format(func_name=CppWorkflow._FUNCTION_NAME,
+'''.format(func_name=CppWorkflow._FUNCTION_NAME + wf_id,
            namespace=CppWorkflow._FUNCTION_NAMESPACE,
            includes=self._includes,
-           lambdas=self._lambdas,
-           nodes=self._nodes_code)
+           n_results=self._res_ptr_id,
+           n_py_actions=len(self._py_actions),
+           lambdas="".join(self._lambdas),
+           nodes="".join(self._nodes_code))
 
         return code
 
-    def _handle_action(self, operation: Action, node_id: int, parent_id: int):
+    def _get_code_hash(self) -> bytes:
+        '''
+        Computes a digest of the full application code together with the
+        version of ROOT. Libraries in the on-disk cache are only reused if both
+        match, so that changes of the code template or of the ROOT build lead
+        to a recompilation.
+        '''
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(self.application_code.encode())
+        hasher.update(f"{ROOT.gROOT.GetVersion()} {ROOT.gROOT.GetGitCommit()}".encode())
+        return hasher.digest()
+
+    def _get_declaration(self, wf_id: str) -> str:
+        '''
+        Composes the declaration of the workflow function with the given id,
+        needed to call it from Python when its shared library was loaded from
+        the on-disk cache instead of being compiled by the current process.
+        '''
+
+        return '''
+{includes}
+
+namespace {namespace} {{
+
+using CppWorkflowResult = std::tuple<std::vector<ROOT::RDF::RResultHandle>,
+                          std::vector<std::string>,
+                          std::vector<ROOT::RDF::RNode>>;
+
+CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0);
+
+}} // namespace {namespace}
+'''.format(func_name=CppWorkflow._FUNCTION_NAME + wf_id,
+           namespace=CppWorkflow._FUNCTION_NAMESPACE,
+           includes=self._includes)
+
+    def _get_graph_hash(self) -> bytes:
+        '''
+        Computes a digest of the structure of the computation graph, i.e. the
+        parts of the graph that determine the generated C++ code. The keyword
+        arguments of the operations are not part of the C++ code, and the range
+        only affects it through the output file name of Snapshot.
+        '''
+
+        hasher = hashlib.blake2b(digest_size=16)
+        has_snapshot = False
+
+        nodes = iter(self.graph_nodes.items())
+        _ = next(nodes)
+        for node_id, node in nodes:
+            operation = node.operation
+            has_snapshot = has_snapshot or isinstance(operation, Snapshot)
+            hasher.update(repr((node_id, operation.name, operation.args, node.parent_id)).encode())
+
+        if has_snapshot:
+            hasher.update(repr(self.range_id).encode())
+
+        return hasher.digest()
+
+    def _handle_action(self, operation: Action, node_id: int, parent_id: int, ctx: _CodegenContext):
         """
         Generates the code for an Action operation. This needs the definition of
         the node running the operation as in the generic case, plus storing the
         RResultPtr into the vector of RResultHandles.
         """
 
-        self._handle_op.dispatch(Operation)(operation, node_id, parent_id)
-
-        # The result is stored in the vector of results to be returned
-        self._nodes_code += f"\n  result_handles.emplace_back(node{node_id});"
+        self._handle_op(operation, node_id, parent_id, ctx)
 
-        # The result type is stored in the vector of result types to be
-        # returned
-        err = f"Cannot get type of result {node_id} of action {operation.name} during generation of RDF C++ workflow"
-        self._nodes_code += (
-            f'\n  auto c{node_id} = TClass::GetClass(typeid(node{node_id}));'
-            f'\n  if (c{node_id} == nullptr)'
-            f'\n    throw std::runtime_error("{err}");'
-            f'\n  result_types.emplace_back(c{node_id}->GetName());'
-        )
+        # The result and its type are stored in the vectors of results and
+        # result types to be returned
+        if ctx.emit_code:
+            self._nodes_code.append(f'{_STATEMENT_SEP}__distrdf_record(node{node_id}, {node_id}, "{operation.name}", result_handles, result_types);')
 
-        self._res_ptr_id += 1
+        ctx.res_ptr_id += 1
 
-    def _handle_asnumpy(self, operation: AsNumpy, node_id: int, parent_id: int):
+    def _handle_asnumpy(self, operation: AsNumpy, node_id: int, parent_id: int, ctx: _CodegenContext):
         '''
         Since AsNumpy is a Python-only action, it can't be included in the
         C++ workflow built by this class. Therefore, this function takes care
@@ -411,47 +830,51 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
 
         # Store DFS-order index of the AsNumpy operation, together with the
         # operation information, for later invocation from Python
-        self._py_actions.append(_PyActionData(self._res_ptr_id, operation))
+        self._py_actions.append(_PyActionData(ctx.res_ptr_id, operation))
 
-        # Save parent RDF node to run AsNumpy on it later from Python
-        self._nodes_code += f"\n  output_nodes.push_back(ROOT::RDF::AsRNode(node{parent_id}));"
+        if ctx.emit_code:
+            # Save parent RDF node to run AsNumpy on it later from Python
+            self._nodes_code.append(f"{_STATEMENT_SEP}output_nodes.push_back(ROOT::RDF::AsRNode(node{parent_id}));")
 
-        # Add placeholders to the result lists
-        self._nodes_code += (
-            "\n  result_handles.emplace_back();"
-            "\n  result_types.emplace_back();"
-        )
+            # Add placeholders to the result lists
+            self._nodes_code.append(
+                f"{_STATEMENT_SEP}result_handles.emplace_back();"
+                f"{_STATEMENT_SEP}result_types.emplace_back();"
+            )
 
-        self._res_ptr_id += 1
+        ctx.res_ptr_id += 1
 
-    def _handle_op(self, operation: Operation, node_id: int, parent_id: int):
+    def _handle_op(self, operation: Operation, node_id: int, parent_id: int, ctx: _CodegenContext):
         """
         Generates the code for a generic operation.
         """
 
+        if not ctx.emit_code:
+            return
+
         op_call = (
             f"node{parent_id}.{operation.name}{self._get_args_template(operation)}"
             f"({self._get_args_call(operation)})"
         )
 
-        self._nodes_code += f"\n  auto node{node_id} = {op_call};"
+        self._nodes_code.append(f"{_STATEMENT_SEP}auto node{node_id} = {op_call};")
 
-    def _handle_snapshot(self, operation: Snapshot, node_id: int, parent_id: int):
+    def _handle_snapshot(self, operation: Snapshot, node_id: int, parent_id: int, ctx: _CodegenContext):
         '''
         Generates the code for the Snapshot operation. Stores the index of the
         returned vector<RResultHandle> in which the result of this Snapshot is
         stored, together with the modified file path.
         '''
 
-        self._snapshots.append(_SnapshotData(self._res_ptr_id, operation.args[0], operation.args[1]))
-        self._handle_action(operation, node_id, parent_id)
+        self._snapshots.append(_SnapshotData(ctx.res_ptr_id, operation.args[0], operation.args[1]))
+        self._handle_action(operation, node_id, parent_id, ctx)
 
-    def _run_function(self, wf_id: int) -> Tuple[List, List[str]]:
+    def _run_function(self, wf_id: str) -> Tuple[List, List[str]]:
         '''
         Runs the workflow generation function.
 
         Args:
-            wf_id (int): identifier of the workflow function to be executed.
+            wf_id (str): identifier of the workflow function to be executed.
 
         Returns:
             tuple: the first element is the list of results of the actions in
@@ -460,7 +883,7 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
         '''
 
         ns = getattr(ROOT, CppWorkflow._FUNCTION_NAMESPACE)
-        func = getattr(ns, CppWorkflow._FUNCTION_NAME + str(wf_id))
+        func = getattr(ns, CppWorkflow._FUNCTION_NAME + wf_id)
 
         # Run the workflow generator function
         vectors = func(self.starting_node)  # need to keep the tuple alive
@@ -469,36 +892,32 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
         # Convert the vector of results into a list so that we can mix
         # different types in it.
         # We copy the results since the life of the original ones is tied to
-        # that of the vector
-        results = [ROOT.RDF.RResultHandle(res) for res in v_results]
-
-        # Strip out the ROOT::RDF::RResultPtr<> part of the type
-        def get_result_type(s):
-            if s.empty():
-                # Python-only actions have an empty return type in C++
-                return ''
-
-            s = str(s)
-            pos = s.find('<')
-            if pos == -1:
-                raise RuntimeError(
-                    'Error parsing the result types of RDataFrame workflow')
-            return s[pos+1:-1].strip()
+        # that of the vector. The copy is done in C++ in one go, the elements
+        # of the list keep the copied vector alive
+        results = list(getattr(ns, "__distrdf_clone")(v_results))
 
-        res_types = [get_result_type(elem) for elem in v_res_types]
+        # The ROOT::RDF::RResultPtr<> part of the types was already stripped
+        # out in C++. Python-only actions have an empty return type
+        res_types = [str(elem) for elem in v_res_types]
 
-        # Add Python-only actions on their corresponding nodes
+        # Add Python-only actions on their corresponding nodes. Their results
+        # are also kept aside to trigger them after the event loop
+        py_results = []
         for (res_ptr_id, operation), n in zip(self._py_actions, v_nodes):
-            operation.kwargs['lazy'] = True  # make it lazy
-            results[res_ptr_id] = getattr(n, operation.name)(*operation.args, **operation.kwargs)
+            kwargs = operation.kwargs
+            kwargs['lazy'] = True  # make it lazy
+            lazy_result = getattr(n, operation.name)(*operation.args, **kwargs)
+            results[res_ptr_id] = lazy_result
+            py_results.append(lazy_result)
 
         if v_results:
-            # We trigger the event loop here, so make sure we release the GIL
-            RunGraphs = ROOT.RDF.RunGraphs
-            old_rg = RunGraphs.__release_gil__
-            RunGraphs.__release_gil__ = True
-            RunGraphs(v_results)
-            RunGraphs.__release_gil__ = old_rg
+            # We trigger the event loop here, so make sure we release the GIL.
+            # This is configured only once per process
+            global _RUNGRAPHS_RELEASES_GIL
+            if not _RUNGRAPHS_RELEASES_GIL:
+                ROOT.RDF.RunGraphs.__release_gil__ = True
+                _RUNGRAPHS_RELEASES_GIL = True
+            ROOT.RDF.RunGraphs(v_results)
 
         # Replace the RResultHandle of each Snapshot by its modified output
         # path, since the latter is what we actually need in the reducer
@@ -507,8 +926,8 @@ CppWorkflowResult {func_name}(ROOT::RDF::RNode &node0)
             res_types[res_ptr_id] = None  # placeholder
 
         # AsNumpyResult needs to be triggered before being merged
-        for i, operation in self._py_actions:
-            results[i].GetValue()
+        for lazy_result in py_results:
+            lazy_result.GetValue()
 
         return results, res_types
 
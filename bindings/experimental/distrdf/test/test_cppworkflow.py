@@ -0,0 +1,369 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import stat
+import tempfile
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+from DistRDF import CppWorkflow
+from DistRDF.Node import Node
+from DistRDF.Operation import create_op
+
+import ROOT
+
+
+def create_graph(*operations):
+    """
+    Create the graph dictionary of a Define node with the given operations as
+    children, like the one received by a distributed task.
+    """
+    headnode = Node(None)
+    define = Node(None, 1, create_op("Define", "x", "rdfentry_"), headnode)
+    graph = {0: headnode, 1: define}
+    for node_id, operation in enumerate(operations, start=2):
+        graph[node_id] = Node(None, node_id, operation, define)
+    return graph
+
+
+class LazySnapshotTest(unittest.TestCase):
+    """Check that Snapshot operations are made lazy without modifying them."""
+
+    def test_original_args_unchanged(self):
+        """The arguments of the original operation are not modified."""
+        op = create_op("Snapshot", "tree", "file.root", ["x", "y"])
+        lazy_op = CppWorkflow._create_lazy_op_if_needed(op, 3)
+
+        self.assertEqual(op.args, ["tree", "file.root", ["x", "y"]])
+        self.assertEqual(lazy_op.args, ["tree", "file_3.root", ["x", "y"], "lazy_options"])
+
+    def test_original_args_unchanged_two_args(self):
+        """No argument is appended to the original operation."""
+        op = create_op("Snapshot", "tree", "file.root")
+        lazy_op = CppWorkflow._create_lazy_op_if_needed(op, 0)
+
+        self.assertEqual(op.args, ["tree", "file.root"])
+        self.assertEqual(lazy_op.args, ["tree", "file_0.root", "", "lazy_options"])
+
+    def test_multiple_ranges(self):
+        """The same operation can be made lazy for different ranges."""
+        op = create_op("Snapshot", "tree", "file.root", "x")
+        lazy_ops = [CppWorkflow._create_lazy_op_if_needed(op, range_id) for range_id in range(3)]
+
+        self.assertEqual(op.args, ["tree", "file.root", "x"])
+        self.assertEqual([lazy_op.args[1] for lazy_op in lazy_ops],
+                         ["file_0.root", "file_1.root", "file_2.root"])
+
+
+class ArgsCallTest(unittest.TestCase):
+    """Check the conversion of operation arguments to C++ call arguments."""
+
+    def setUp(self):
+        """Create a workflow whose methods generate the call arguments."""
+        self.wf = CppWorkflow.CppWorkflow(create_graph(create_op("Count")), ROOT.RDataFrame(10), 0)
+
+    def get_args_call(self, *args):
+        """Return the C++ call arguments of an operation with the given args."""
+        return self.wf._get_args_call(create_op("Define", *args))
+
+    def test_str(self):
+        """Strings are quoted."""
+        self.assertEqual(self.get_args_call("x", "rdfentry_ * 2"), '"x", "rdfentry_ * 2"')
+
+    def test_lazy_options(self):
+        """The placeholder of the Snapshot options is not quoted."""
+        self.assertEqual(self.get_args_call("tree", "lazy_options"), '"tree", lazy_options')
+
+    def test_tuple(self):
+        """Tuples become initializer lists, with their strings quoted."""
+        self.assertEqual(self.get_args_call(("x", "y"), (1, 2.5)), '{"x","y"}, {1,2.5}')
+
+    def test_nested_tuple(self):
+        """Only the outer tuple becomes an initializer list."""
+        self.assertEqual(self.get_args_call(("x", ("y", 1))), "{\"x\",('y', 1)}")
+
+    def test_numbers(self):
+        """Numbers are converted to their string representation."""
+        self.assertEqual(self.get_args_call(1, 2.5, True), "1, 2.5, True")
+
+    def test_str_subclass(self):
+        """Subclasses of str are quoted like strings."""
+        class Name(str):
+            pass
+
+        self.assertEqual(self.get_args_call(Name("x"), Name("lazy_options")), '"x", lazy_options')
+
+    def test_namedtuple(self):
+        """Namedtuples become initializer lists like tuples."""
+        Point = namedtuple("Point", ["x", "y"])
+
+        self.assertEqual(self.get_args_call(Point("a", 1)), '{"a",1}')
+
+
+class WorkflowCacheTest(unittest.TestCase):
+    """
+    Check that workflows already loaded by the process are found in the cache
+    through the structure of their graph.
+    """
+
+    def setUp(self):
+        """Save the state of the cache and use a fresh RDataFrame."""
+        self.cached_wfs = dict(CppWorkflow.CppWorkflow._CACHED_WFS)
+        self.rdf = ROOT.RDataFrame(10)
+
+    def tearDown(self):
+        """Restore the state of the cache."""
+        CppWorkflow.CppWorkflow._CACHED_WFS.clear()
+        CppWorkflow.CppWorkflow._CACHED_WFS.update(self.cached_wfs)
+
+    def load_workflow(self, graph, range_id):
+        """Create a workflow and register it in the cache as if it was loaded."""
+        wf = CppWorkflow.CppWorkflow(graph, self.rdf, range_id)
+        CppWorkflow.CppWorkflow._CACHED_WFS[wf._graph_hash] = wf._wf_id
+        return wf
+
+    def test_hit_across_ranges(self):
+        """A graph without Snapshot is found in the cache for any range."""
+        graph = create_graph(create_op("Count"), create_op("Sum", "x"))
+        wf_first = self.load_workflow(graph, 0)
+
+        wf_second = CppWorkflow.CppWorkflow(graph, self.rdf, 1)
+
+        self.assertTrue(wf_first._code_generated)
+        self.assertFalse(wf_second._code_generated)
+        self.assertEqual(wf_second._graph_hash, wf_first._graph_hash)
+        self.assertEqual(wf_second._wf_id, wf_first._wf_id)
+
+    def test_miss_across_ranges_with_snapshot(self):
+        """A graph with Snapshot is not found in the cache for other ranges."""
+        graph = create_graph(create_op("Count"), create_op("Snapshot", "tree", "file.root", "x"))
+        wf_first = self.load_workflow(graph, 0)
+
+        wf_second = CppWorkflow.CppWorkflow(graph, self.rdf, 1)
+
+        self.assertTrue(wf_second._code_generated)
+        self.assertNotEqual(wf_second._graph_hash, wf_first._graph_hash)
+        self.assertNotEqual(wf_second._wf_id, wf_first._wf_id)
+
+    def test_code_generated_once(self):
+        """The hash of the final code does not require building it again."""
+        graph = create_graph(create_op("Count"), create_op("Sum", "x"))
+        with mock.patch.object(CppWorkflow.CppWorkflow, "_get_code", autospec=True,
+                               side_effect=CppWorkflow.CppWorkflow._get_code) as get_code:
+            wf = CppWorkflow.CppWorkflow(graph, self.rdf, 0)
+            self.assertEqual(get_code.call_count, 0)
+
+            wf._get_code_hash()
+            self.assertEqual(get_code.call_count, 1)
+
+        self.assertEqual(wf._wf_id, wf._graph_hash.hex()[:16])
+        self.assertIn(f"{CppWorkflow.CppWorkflow._FUNCTION_NAME}{wf._wf_id}(", wf.application_code)
+
+    def test_hit_collects_run_information(self):
+        """The information needed to run the workflow is collected on a hit."""
+        graph = create_graph(create_op("Count"),
+                             create_op("AsNumpy", ["x"]),
+                             create_op("Snapshot", "tree", "file.root", "x"),
+                             create_op("Sum", "x"))
+        wf_first = self.load_workflow(graph, 2)
+
+        wf_second = CppWorkflow.CppWorkflow(graph, self.rdf, 2)
+
+        self.assertFalse(wf_second._code_generated)
+        self.assertEqual(wf_second._res_ptr_id, wf_first._res_ptr_id)
+        self.assertEqual(wf_second._snapshots, wf_first._snapshots)
+        self.assertEqual(wf_second._py_actions, wf_first._py_actions)
+        self.assertEqual(wf_second._snapshots, [CppWorkflow._SnapshotData(2, "tree", "file_2.root")])
+        self.assertEqual([data.res_id for data in wf_second._py_actions], [1])
+        # The code is still generated on demand
+        self.assertEqual(wf_second.application_code, wf_first.application_code)
+
+
+class CacheDirTest(unittest.TestCase):
+    """
+    Check that compiled workflows are only shared through a directory that
+    belongs to the current user and that no one else can write to.
+    """
+
+    def setUp(self):
+        """Use a fresh temporary directory and an unset cache directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env_cache = os.environ.pop("DISTRDF_WF_CACHE", None)
+        CppWorkflow._CACHE_DIR = None
+
+    def tearDown(self):
+        """Restore the environment and remove the temporary directory."""
+        CppWorkflow._CACHE_DIR = None
+        os.environ.pop("DISTRDF_WF_CACHE", None)
+        if self.env_cache is not None:
+            os.environ["DISTRDF_WF_CACHE"] = self.env_cache
+        self.tmpdir.cleanup()
+
+    def get_cache_dir(self, path):
+        """Return the cache directory chosen when DISTRDF_WF_CACHE is path."""
+        os.environ["DISTRDF_WF_CACHE"] = path
+        cache_dir = CppWorkflow._get_cache_dir()
+        if cache_dir != path:
+            self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        return cache_dir
+
+    def test_env_var_honoured(self):
+        """The directory set in DISTRDF_WF_CACHE is created and used."""
+        path = os.path.join(self.tmpdir.name, "cache")
+
+        self.assertEqual(self.get_cache_dir(path), path)
+        self.assertTrue(CppWorkflow._is_private_dir(path))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode) & 0o077, 0)
+
+    def test_writable_by_others_rejected(self):
+        """A directory writable by group or others is not used."""
+        for mode in (0o770, 0o707):
+            path = os.path.join(self.tmpdir.name, f"cache_{mode:o}")
+            os.mkdir(path)
+            os.chmod(path, mode)
+            CppWorkflow._CACHE_DIR = None
+
+            self.assertFalse(CppWorkflow._is_private_dir(path))
+            cache_dir = self.get_cache_dir(path)
+            self.assertNotEqual(cache_dir, path)
+            self.assertTrue(CppWorkflow._is_private_dir(cache_dir))
+
+    def test_symlink_rejected(self):
+        """A symbolic link to a private directory is not used."""
+        target = os.path.join(self.tmpdir.name, "target")
+        os.mkdir(target, 0o700)
+        path = os.path.join(self.tmpdir.name, "link")
+        os.symlink(target, path)
+
+        self.assertTrue(CppWorkflow._is_private_dir(target))
+        self.assertFalse(CppWorkflow._is_private_dir(path))
+        self.assertNotEqual(self.get_cache_dir(path), path)
+
+
+class CompilationLockTest(unittest.TestCase):
+    """
+    Check that only one process compiles a workflow, and that the locks of
+    processes that don't hold them anymore are taken over or released.
+    """
+
+    def setUp(self):
+        """Put the lock and the library of the workflow in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.lib_path = os.path.join(self.tmpdir.name, "rdfworkflow_test")
+        self.lock_path = f"{self.lib_path}.lock"
+        self.so_path = f"{self.lib_path}.so"
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def write_lock(self, host, pid, age=0):
+        """Create a lock owned by the given process, modified age seconds ago."""
+        with open(self.lock_path, "w") as f:
+            f.write(f"{host} {pid}")
+        mtime = os.path.getmtime(self.lock_path) - age
+        os.utime(self.lock_path, (mtime, mtime))
+
+    def read_lock(self):
+        """Return the owner written in the lock."""
+        with open(self.lock_path) as f:
+            return f.read()
+
+    def mock_root(self, compiled):
+        """
+        Replace ROOT in the CppWorkflow module, so that the compilation only
+        succeeds if compiled is True.
+        """
+        root = mock.MagicMock()
+        root.gSystem.GetSoExt.return_value = "so"
+
+        def compile_macro(cpp_file_name, options, lib_path):
+            if compiled:
+                open(f"{lib_path}.so", "w").close()
+            return compiled
+
+        root.gSystem.CompileMacro.side_effect = compile_macro
+        patcher = mock.patch.object(CppWorkflow, "ROOT", root)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        cache_patcher = mock.patch.object(CppWorkflow, "_get_cache_dir", return_value=self.tmpdir.name)
+        self.addCleanup(cache_patcher.stop)
+        cache_patcher.start()
+        return root
+
+    def test_dead_owner_taken_over(self):
+        """The lock of a process that does not exist anymore is taken over."""
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        self.write_lock(socket.gethostname(), dead.pid)
+
+        self.assertTrue(CppWorkflow._is_stale_lock(self.lock_path))
+        self.assertTrue(CppWorkflow._acquire_compilation_lock(self.lock_path, self.so_path))
+        self.assertEqual(self.read_lock(), f"{socket.gethostname()} {os.getpid()}")
+
+    def test_alive_owner_not_stale(self):
+        """The lock of a running process on the same host is never stale."""
+        self.write_lock(socket.gethostname(), os.getpid(), age=2 * CppWorkflow._COMPILATION_TIMEOUT)
+
+        self.assertFalse(CppWorkflow._is_stale_lock(self.lock_path))
+
+    def test_other_host_owner_stale_after_timeout(self):
+        """The lock of a process on another host is stale once it is old."""
+        self.write_lock("other-host-" + socket.gethostname(), 1)
+        self.assertFalse(CppWorkflow._is_stale_lock(self.lock_path))
+
+        self.write_lock("other-host-" + socket.gethostname(), 1, age=2 * CppWorkflow._COMPILATION_TIMEOUT)
+        self.assertTrue(CppWorkflow._is_stale_lock(self.lock_path))
+
+    def test_lock_released_on_failed_compilation(self):
+        """The lock is removed if the compilation fails."""
+        self.mock_root(compiled=False)
+
+        with self.assertRaises(RuntimeError):
+            CppWorkflow._build_workflow_library("", "test")
+
+        self.assertFalse(os.path.exists(self.lock_path))
+        self.assertFalse(os.path.exists(self.so_path))
+
+    def test_library_compiled(self):
+        """The library is compiled and published, and the lock is removed."""
+        root = self.mock_root(compiled=True)
+
+        self.assertEqual(CppWorkflow._build_workflow_library("", "test"), self.so_path)
+
+        root.gSystem.CompileMacro.assert_called_once()
+        self.assertTrue(os.path.exists(self.so_path))
+        self.assertTrue(os.path.exists(f"{self.lib_path}.cxx"))
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_existing_library_not_compiled(self):
+        """A library that was already published is not compiled again."""
+        root = self.mock_root(compiled=True)
+        open(self.so_path, "w").close()
+
+        self.assertFalse(CppWorkflow._acquire_compilation_lock(self.lock_path, self.so_path))
+        self.assertEqual(CppWorkflow._build_workflow_library("", "test"), self.so_path)
+
+        root.gSystem.CompileMacro.assert_not_called()
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_library_published_while_acquiring(self):
+        """
+        A library published by the previous owner of the lock right before
+        releasing it is not compiled again, and the lock is released.
+        """
+        root = self.mock_root(compiled=True)
+
+        def acquire_after_publication(lock_path, so_path):
+            open(so_path, "w").close()
+            self.write_lock(socket.gethostname(), os.getpid())
+            return True
+
+        with mock.patch.object(CppWorkflow, "_acquire_compilation_lock", side_effect=acquire_after_publication):
+            self.assertEqual(CppWorkflow._build_workflow_library("", "test"), self.so_path)
+
+        root.gSystem.CompileMacro.assert_not_called()
+        self.assertFalse(os.path.exists(self.lock_path))